@@ -17,11 +17,21 @@ import os
 import shutil
 from typing import Sequence
 import glob
+import mmap
 import datetime
 import re
 import sys
+import urllib.parse
 import yaml
+import numpy as np
 
+# Layout of the feature store and of the collection-wide feature index
+feature_columns = ['seqid','start','end','strand','type','locus_tag','gene','product']
+strand_codes = {'+': 1, '-': -1}
+strand_symbols = {1: '+', -1: '-', 0: '.'}
+search_blob_name = "search.bin"
+search_offsets_name = "search_offsets.npy"
+feature_index_name = "feature_index"
 
 def get_arguments():
 	"""Parsing the arguments"""
@@ -68,11 +78,13 @@ Options:
 	--biosample  If annotation must be submitted to the NCBI, use this option to mention the correct biosample (default : SAMN99999999)
 	--locustag   If annotation must be submitted to the NCBI, use this option to mention the correct locus_tag (default : TMLOC).
 	--debug		 Debug mode to print more informations in the log
+	--query      Do not run the pipeline, look instead for a gene, locus_tag or product in the feature index of the collection (-s is then not needed)
+	--query_type Restrict the query to one type of feature, for example CDS (default : all types)
     
 
 ______________________________________________________________________
 ''')
-	parser.add_argument("-s", "--strain", help="The strain you wich to work on.", required=True)
+	parser.add_argument("-s", "--strain", help="The strain you wich to work on.", required=False)
 	parser.add_argument("-d", "--indir", help="The directory on Ilis where to look for the strain (default : /vol/local/1-MBT-collection) ", required=False, default="/vol/local/1-MBT-collection")
 	parser.add_argument("-ia", "--input_assembly", help="Start the pipeline directly at the annotation step.", required=False, action='store_true')
 	parser.add_argument("-as", "--antismash", help="Start the pipeline only from the antismash step.", default=False, action='store_true')
@@ -88,7 +100,12 @@ ______________________________________________________________________
 	parser.add_argument("--biosample", "--biosample", help="If annotation must be submitted to the NCBI, use this option to mention the correct biosample (default : SAMN99999999).", default="SAMN99999999")
 	parser.add_argument("--locustag", "--locustag", help="If annotation must be submitted to the NCBI, use this option to mention the correct locus_tag (default : TMLOC).", default="TMLOC")
 	parser.add_argument("--pgap", "--pgap", help="If annotation must be submitted to the NCBI, use this option to run annotation step using PGAP instead of prokka.", action='store_true')
-	return (parser.parse_args())
+	parser.add_argument("--query", "--query", help="Look for a gene, locus_tag or product in the feature index of the collection instead of running the pipeline.", required=False, default=None)
+	parser.add_argument("--query_type", "--query_type", help="Restrict the query to one type of feature, for example CDS (default : all types).", required=False, default=None)
+	args = parser.parse_args()
+	if (args.strain is None) and (args.query is None):
+		parser.error("the following arguments are required: -s/--strain")
+	return (args)
  
 def return_reads(workdir):
 	# This function parse {workdir} and is looking for files that could be raw reads (.gz accepted), eg .fastq or .fq
@@ -501,6 +518,207 @@ def annotation_pgap(assembly,workdir,tag,assembly_version,args):
 		logger.error(e, exc_info=True)
 		raise
 
+def parse_gff(gff):
+	# Read the features of the annotation file {gff} (prokka or PGAP flavour of GFF3)
+	# Stops at the ##FASTA section prokka appends at the end of its gff
+	# Only gene= is used for the gene column : in PGAP gff, Name= holds the protein accession or the locus_tag
+	# It returns a dictionnary with the column names of the feature store as keys and lists of values as values
+	columns = {name: [] for name in feature_columns}
+	with open(gff, "rt") as fin:
+		for line in fin:
+			if line.startswith("##FASTA"):
+				break
+			if line.startswith("#") or not line.strip():
+				continue
+			fields = line.rstrip("\n").split("\t")
+			if len(fields) != 9:
+				logger.debug('---------- Skipping malformed gff line : {}'.format(line.strip()))
+				continue
+			attributes = {}
+			for attribute in fields[8].split(";"):
+				if "=" in attribute:
+					key, value = attribute.split("=", 1)
+					#Escaped tabs and line breaks (%09, %0A) would break the tsv output and the search file, they become spaces
+					attributes[key] = re.sub(r"[\t\r\n\0]", " ", urllib.parse.unquote(value))
+			columns["seqid"].append(fields[0])
+			columns["type"].append(fields[2])
+			columns["start"].append(int(fields[3]))
+			columns["end"].append(int(fields[4]))
+			columns["strand"].append(strand_codes.get(fields[6], 0))
+			columns["locus_tag"].append(attributes.get("locus_tag", ""))
+			columns["gene"].append(attributes.get("gene", ""))
+			columns["product"].append(attributes.get("product", ""))
+	return columns
+
+def feature_store_files(store):
+	# Return the list of files a complete feature store {store} must contain
+	return [store + "/" + column + ".npy" for column in feature_columns] + [store + "/" + search_blob_name, store + "/" + search_offsets_name]
+
+def feature_store(gff,workdir):
+	# Convert the annotation file {gff} into a columnar feature store written in the {workdir} directory
+	# Each column is saved as its own .npy file so it can be memory-mapped later and only the needed columns are read
+	# Text columns are stored as fixed width byte strings, sized on the longest value of the strain
+	# A lower-cased search key "locus_tag\0gene\0product\n" per feature is also written as one flat file with the offset of each row,
+	# so a query is a single search through that file instead of a string operation per feature
+	# Everything is written in {store}.tmp first and then swapped in place, so a query never sees a half written store
+	# It returns the path of the feature store and the number of features it contains
+	name = os.path.basename(gff)
+	prefix, extension = os.path.splitext(name)
+	store = workdir + "/" + prefix + "_features"
+	temp_store = store + ".tmp"
+	old_store = store + ".old"
+	try:
+		columns = parse_gff(gff)
+		for leftover in (temp_store, old_store):
+			if (os.path.isdir(leftover)):
+				logger.warning('---------- Removing leftover folder {} from a previous run.'.format(leftover))
+				shutil.rmtree(leftover)
+		os.makedirs(temp_store)
+		for column in feature_columns:
+			if column in ("start", "end"):
+				array = np.array(columns[column], dtype=np.int64)
+			elif column == "strand":
+				array = np.array(columns[column], dtype=np.int8)
+			else:
+				array = np.array([value.encode("utf-8") for value in columns[column]], dtype=np.bytes_)
+			np.save(temp_store + "/" + column + ".npy", array)
+		n_features = len(columns["start"])
+		offsets = np.zeros(n_features, dtype=np.int64)
+		position = 0
+		with open(temp_store + "/" + search_blob_name, "wb") as fout:
+			for i in range(n_features):
+				key = "\0".join((columns["locus_tag"][i], columns["gene"][i], columns["product"][i])).lower().encode("utf-8") + b"\n"
+				offsets[i] = position
+				position += len(key)
+				fout.write(key)
+		np.save(temp_store + "/" + search_offsets_name, offsets)
+		#A directory cannot be replaced in one go, the old store is moved aside and removed once the new one is in place
+		#Queries that still have old files memory-mapped keep reading them safely, unlinked files are not truncated
+		if (os.path.isdir(store)):
+			os.replace(store, old_store)
+		os.replace(temp_store, store)
+		if (os.path.isdir(old_store)):
+			shutil.rmtree(old_store)
+		logger.info('---------- Wrote {} features from {} into {} .'.format(n_features,gff,store))
+		return store, n_features
+	except Exception as e:
+		logger.error('---------- Feature store ended unexpectedly :( ')
+		logger.error(e, exc_info=True)
+		raise
+
+def update_feature_index(indir,tag,store,n_features):
+	# Register the feature store {store} of the strain {tag} in the collection-wide index found at the root of {indir}
+	# The index is a folder with one entry file per strain, so pipelines running at the same time on different strains never write to the same file
+	# The entry is written in a temporary file then moved, so a query never reads a half written entry
+	index_dir = indir + "/" + feature_index_name
+	entry = index_dir + "/" + tag + ".tsv"
+	temp_entry = entry + ".tmp"
+	try:
+		if not (os.path.isdir(index_dir)):
+			logger.info('---------- Creating folder {} .'.format(index_dir))
+			os.makedirs(index_dir, exist_ok=True)
+		with open(temp_entry, "wt") as fout:
+			fout.write("\t".join([tag, os.path.relpath(store, indir), str(n_features)]) + "\n")
+		os.replace(temp_entry, entry)
+		logger.info('---------- Registered {} in the feature index {} .'.format(tag,index_dir))
+	except Exception as e:
+		logger.error('---------- Could not update the feature index {} :( '.format(index_dir))
+		logger.error(e, exc_info=True)
+		raise
+
+def is_feature_indexed(indir,tag,store,gff):
+	# Check that the strain {tag} has an entry in the feature index of {indir} pointing to {store}, and that this store is complete
+	# The store is also considered stale when the annotation {gff} was written after it, for example when prokka or PGAP
+	# ran again with the same prefix (-ia, or a second run the same day) and the feature store failed afterwards
+	entry = indir + "/" + feature_index_name + "/" + tag + ".tsv"
+	if not (os.path.isfile(entry)):
+		return False
+	with open(entry, "rt") as fin:
+		fields = fin.readline().rstrip("\n").split("\t")
+	if (len(fields) != 3) or (indir + "/" + fields[1] != store):
+		return False
+	if not all(os.path.isfile(path) for path in feature_store_files(store)):
+		return False
+	return os.path.getmtime(gff) <= os.path.getmtime(store + "/" + search_blob_name)
+
+def build_feature_store(gff,indir,tag):
+	# Wrapper of feature_store and update_feature_index used by the pipeline
+	# The feature store is only derived from the annotation and can be rebuilt later with -as,
+	# so a failure here is logged but does not stop the rest of the pipeline
+	# The index entry of the strain is removed on failure, so queries do not return features of an older annotation
+	logger.info('----- FEATURE STORE STARTED ')
+	try:
+		store, n_features = feature_store(gff,os.path.dirname(gff))
+		update_feature_index(indir,tag,store,n_features)
+		logger.info('----- FEATURE STORE DONE ')
+	except Exception:
+		entry = indir + "/" + feature_index_name + "/" + tag + ".tsv"
+		if (os.path.isfile(entry)):
+			logger.warning('---------- Removing the outdated feature index entry {} .'.format(entry))
+			os.remove(entry)
+		logger.warning('---------- Feature store failed for {}, carrying on. Run again with -as to rebuild it.'.format(tag))
+
+def query_features(indir,term,feature_type):
+	# Look for {term} in the locus_tag, gene and product of all strains registered in the feature index of {indir}
+	# The match is case insensitive, and can be restricted to a given {feature_type} (CDS, gene, tRNA...)
+	# Only the search file of each strain is scanned, the other columns are memory-mapped for strains with hits only
+	# Write the matching features as a tsv on the standard output
+	# Strains that could not be read are reported on the standard error, and the query then exits with an error
+	# so an incomplete answer is never mistaken for a complete one
+	index_dir = indir + "/" + feature_index_name
+	if (not os.path.isdir(index_dir)):
+		sys.exit('---------- No feature index {} found, run the annotation step on some strains first.'.format(index_dir))
+	needle = term.lower().encode("utf-8")
+	if (not needle) or (b"\0" in needle) or (b"\n" in needle):
+		sys.exit('---------- The query must be a non empty string without line breaks.')
+	skipped = []
+	sys.stdout.write("strain\tseqid\tstart\tend\tstrand\tlength\ttype\tlocus_tag\tgene\tproduct\n")
+	for entry in sorted(glob.glob(index_dir + "/*.tsv")):
+		tag = os.path.splitext(os.path.basename(entry))[0]
+		store = "unknown"
+		try:
+			with open(entry, "rt") as fin:
+				fields = fin.readline().rstrip("\n").split("\t")
+			if len(fields) != 3:
+				raise ValueError("malformed index entry, expected 3 fields but found {}".format(len(fields)))
+			tag, store, n_features = fields
+			store = indir + "/" + store
+			if int(n_features) == 0:
+				continue
+			with open(store + "/" + search_blob_name, "rb") as fin:
+				if os.fstat(fin.fileno()).st_size == 0:
+					raise ValueError("empty {} for {} features".format(search_blob_name, n_features))
+				with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+					positions = []
+					position = blob.find(needle)
+					while position != -1:
+						positions.append(position)
+						position = blob.find(needle, position + 1)
+			if not positions:
+				continue
+			offsets = np.load(store + "/" + search_offsets_name, mmap_mode="r")
+			rows = np.unique(np.searchsorted(offsets, positions, side="right") - 1)
+			columns = {}
+			for column in feature_columns:
+				columns[column] = np.load(store + "/" + column + ".npy", mmap_mode="r")
+			if feature_type:
+				rows = rows[columns["type"][rows] == feature_type.encode("utf-8")]
+			lines = []
+			for i in rows:
+				start = int(columns["start"][i])
+				end = int(columns["end"][i])
+				row = [tag, columns["seqid"][i].decode(), str(start), str(end), strand_symbols[int(columns["strand"][i])], str(end - start + 1)]
+				row += [columns[column][i].decode() for column in ("type", "locus_tag", "gene", "product")]
+				lines.append("\t".join(row) + "\n")
+		except (OSError, ValueError, IndexError, KeyError) as e:
+			#The store may be broken, or swapped by a pipeline running at the same time on this strain
+			sys.stderr.write("---------- Skipped strain {} (index entry {}, store {}) : {}\n".format(tag, entry, store, e))
+			skipped.append(tag)
+			continue
+		sys.stdout.writelines(lines)
+	if skipped:
+		sys.exit("---------- {} strain(s) could not be read, the results above are incomplete : {}".format(len(skipped), ", ".join(skipped)))
+
 def antismash(gbk,workdir,tag,args):
 	# This function perform Biosynthethic Gene Cluster discovery on a given gbk file {gbk}
 	# Use the prefix {tag} to rename the html file
@@ -534,6 +752,10 @@ def multiqc(outdir):
 def main():
 	#----------------------Args and global------------------------
 	args = get_arguments()
+	#-----------------------Query mode----------------------------
+	if args.query is not None:
+		query_features(args.indir,args.query,args.query_type)
+		return
 	tag = args.strain
 	workdir = args.indir + '/' + args.strain
 	assembly_dir = workdir + '/assembly'
@@ -634,8 +856,12 @@ def main():
 		logger.debug('---------- Using latest assembly for annotation : '.format(latest_assembly))
 		if not (args.pgap):
 			annotation_prokka(latest_assembly,annotation_dir+"/prokka",multiqc_dir,tag,assembly_version,args)
+			annotation_gff = annotation_dir + "/prokka/" + assembly_version + "_prokka.gff"
 		else:
 			annotation_pgap(latest_assembly,annotation_dir+"/pgap",tag,assembly_version,args)
+			annotation_gff = annotation_dir + "/pgap/" + assembly_version + "_pgap.gff"
+		#-----------------------Feature store------------------------
+		build_feature_store(annotation_gff,args.indir,tag)
 		#--------------------------MultiQc---------------------------
 		logger.info('----- GENOMES QC STARTED ')
 		list_assemblies = ""
@@ -652,6 +878,11 @@ def main():
 	#Starting here antismash
 	list_gbk = glob.glob(annotation_dir+'/*/*.gbk')
 	latest_gbk = max(list_gbk, key=os.path.getctime)
+	#Strains annotated before the feature store existed, or whose store or index entry is broken, get it rebuilt here
+	if args.antismash:
+		latest_gff = os.path.splitext(latest_gbk)[0] + ".gff"
+		if (os.path.isfile(latest_gff)) and not is_feature_indexed(args.indir,tag,os.path.splitext(latest_gff)[0] + "_features",latest_gff):
+			build_feature_store(latest_gff,args.indir,tag)
 	logger.info('--- Third part : BGC discovery ')
 	logger.info('----- ANTISMASH STARTED ')
 	logger.debug('---------- Started for {} '.format(latest_gbk))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Timing check of the feature store query of Quasan.
+Builds a synthetic collection of prokka-like gff files in a temporary folder,
+converts them into feature stores, then times a query over the whole collection.
+Exits with an error if the query takes longer than the allowed time.
+"""
+
+# Import statements
+import argparse
+import contextlib
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import Quasan
+
+
+def get_arguments():
+	"""Parsing the arguments"""
+	parser = argparse.ArgumentParser(description="Timing check of the feature store query of Quasan.")
+	parser.add_argument("--strains", help="The number of synthetic strains in the collection (default : 500)", type=int, default=500)
+	parser.add_argument("--features", help="The number of features per strain, prokka with --addgenes gives roughly 15000 (default : 15000)", type=int, default=15000)
+	parser.add_argument("--max_seconds", help="The maximum time allowed for a query over the whole collection (default : 10)", type=float, default=10)
+	parser.add_argument("--keep", help="Keep the synthetic collection instead of removing it.", action='store_true')
+	return (parser.parse_args())
+
+def write_gff(gff,tag,n_features):
+	# Write a prokka-like gff with {n_features} features, alternating gene and CDS lines
+	# One CDS out of a thousand is a "dnaA" so the query has hits to gather in every strain
+	with open(gff, "wt") as fout:
+		fout.write("##gff-version 3\n")
+		for i in range(n_features // 2):
+			locus_tag = "{}_{:05d}".format(tag, i)
+			gene = "dnaA" if i % 1000 == 0 else ""
+			product = "Chromosomal replication initiator protein DnaA" if gene else "hypothetical protein number {}".format(i)
+			start = i * 1000 + 1
+			end = start + 899
+			strand = "+" if i % 2 else "-"
+			fout.write("contig_1\tProdigal:002006\tgene\t{}\t{}\t.\t{}\t.\tID={}_gene;gene={};locus_tag={}\n".format(start, end, strand, locus_tag, gene, locus_tag))
+			fout.write("contig_1\tProdigal:002006\tCDS\t{}\t{}\t.\t{}\t0\tID={};gene={};locus_tag={};product={}\n".format(start, end, strand, locus_tag, gene, locus_tag, product))
+
+def main():
+	args = get_arguments()
+	Quasan.logger = logging.getLogger('quasan_logger')
+	indir = tempfile.mkdtemp(prefix="quasan_bench_")
+	try:
+		build_start = time.perf_counter()
+		for n in range(args.strains):
+			tag = "SYN{}".format(n)
+			workdir = indir + "/" + tag + "/annotation/prokka"
+			os.makedirs(workdir)
+			gff = workdir + "/custom_" + tag + "_prokka.gff"
+			write_gff(gff, tag, args.features)
+			store, n_features = Quasan.feature_store(gff, workdir)
+			Quasan.update_feature_index(indir, tag, store, n_features)
+		build_time = time.perf_counter() - build_start
+		print("Built {} feature stores of {} features in {:.1f} s ({:.3f} s per strain)".format(args.strains, args.features, build_time, build_time / args.strains))
+		output = io.StringIO()
+		query_start = time.perf_counter()
+		with contextlib.redirect_stdout(output):
+			Quasan.query_features(indir, "dnaa", "CDS")
+		query_time = time.perf_counter() - query_start
+		hits = output.getvalue().count("\n") - 1
+		expected = args.strains * len(range(0, args.features // 2, 1000))
+		print("Queried {} strains in {:.2f} s, {} hits".format(args.strains, query_time, hits))
+		if hits != expected:
+			sys.exit("Expected {} hits but got {} :(".format(expected, hits))
+		if query_time > args.max_seconds:
+			sys.exit("The query took longer than {} s :(".format(args.max_seconds))
+	finally:
+		if args.keep:
+			print("Synthetic collection kept in {}".format(indir))
+		else:
+			shutil.rmtree(indir)
+
+if __name__ == '__main__':
+	main()